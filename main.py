@@ -1,20 +1,51 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import psycopg2
-import json
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import Annotated
+from operator import attrgetter
+from collections import OrderedDict
+import shapely
+import asyncpg
+import orjson
 from dotenv import load_dotenv
 import os
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 load_dotenv()
 
 # Pydantic models for request/response
+# [lat, lng] pair, parsed and range-checked by pydantic-core
+LatLng = tuple[Annotated[float, Field(ge=-90, le=90)], Annotated[float, Field(ge=-180, le=180)]]
+
 class CoordinateRequest(BaseModel):
-    start_coords: str  # Format: "lat,lng" e.g., "43.43656,-80.45172"
-    end_coords: str    # Format: "lat,lng" e.g., "43.43656,-80.45172"
+    start_coords: LatLng  # Format: [lat, lng] e.g., [43.43656, -80.45172]
+    end_coords: LatLng    # Format: [lat, lng] e.g., [43.43656, -80.45172]
+
+class GeocodeResult(BaseModel):
+    stop_number: int | None = None
+    address: str = ""
+    lat: float | None = None
+    lng: float | None = None
+    formatted_address: str = ""
+    status: str = ""
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_successful_stop(cls, data):
+        """Require a position for stops that will be routed; failed geocodes are kept as their status only"""
+        if not isinstance(data, dict):
+            return data
+        if data.get("status") != "success":
+            # Whatever else a failed geocode carries (e.g. "lat": "") is never used
+            status = data.get("status")
+            return {"status": status if isinstance(status, str) else ""}
+        missing = [name for name in ("stop_number", "lat", "lng") if data.get(name) is None]
+        if missing:
+            raise ValueError(f"Successful geocode result is missing {', '.join(missing)}")
+        return data
 
 class RouteFromBatchRequest(BaseModel):
-    geocode_results: list[dict]
+    geocode_results: list[GeocodeResult]
 
 class RouteFromBatchResponse(BaseModel):
     success: bool
@@ -24,21 +55,297 @@ class RouteFromBatchResponse(BaseModel):
     total_time_min: float | None = None
     segment_count: int | None = None
 
-def get_connection():
-    return psycopg2.connect(
-        dbname="kitchener_routing",
-        user="postgres",
-        password="takeme@kw",
-        host="localhost",
-        port="5432"
+# Connections per worker
+POOL_MIN_SIZE = 5
+POOL_MAX_SIZE = 20
+
+# Seconds to wait for a free pooled connection before failing the request
+ACQUIRE_TIMEOUT = 2.0
+
+# Any routable edge of the contracted graph gives a real leg to warm up with
+WARMUP_LEG_QUERY = "SELECT source, target FROM ways_contracted WHERE cost > 0 LIMIT 1"
+
+@app.on_event("startup")
+async def open_pool():
+    # Connection pool, created once per worker; min_size connections are opened up front
+    app.state.pool = await asyncpg.create_pool(
+        database=os.getenv("DB_NAME", "kitchener_routing"),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASSWORD", "takeme@kw"),
+        # PgBouncer (transaction pooling) in front of PostgreSQL
+        host=os.getenv("DB_HOST", "localhost"),
+        port=int(os.getenv("DB_PORT", "6432")),
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE
     )
+    # Route one real leg through the multi-stop query before serving traffic, so
+    # the tables pgr_astar loads are in shared buffers for the first request.
+    # Goes straight to the query so the leg cache stays empty.
+    async with app.state.pool.acquire() as conn:
+        leg = await conn.fetchrow(WARMUP_LEG_QUERY)
+        if leg is not None:
+            await conn.fetch(ROUTE_LEGS_QUERY, [leg["source"]], [leg["target"]])
+
+@app.on_event("shutdown")
+async def close_pool():
+    await app.state.pool.close()
+
+# Routing queries use a fixed text with bound parameters so PostgreSQL parses
+# the same statement every time and lat/lng values are never inlined
+SNAP_STOPS_QUERY = """
+WITH stops AS (
+  SELECT id, ST_SetSRID(ST_MakePoint(lng, lat), 4326) AS geom
+  FROM unnest($1::float8[], $2::float8[]) WITH ORDINALITY AS t(lng, lat, id)
+),
+snap AS (
+  SELECT 
+    s.id,
+    s.geom,
+    snapped.vertex_id
+  FROM stops s
+  CROSS JOIN LATERAL (
+    -- Try to find closest road segment with direction-aware snapping
+    (
+      SELECT 
+        CASE 
+          -- For first stop, use closest vertex
+          WHEN s.id = 1 THEN
+            CASE 
+              WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
+                   ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
+              THEN w.source
+              ELSE w.target
+            END
+          -- For last stop, use closest vertex
+          WHEN s.id = (SELECT MAX(id) FROM stops) THEN
+            CASE 
+              WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
+                   ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
+              THEN w.source
+              ELSE w.target
+            END
+          -- For intermediate stops, prefer vertex that allows forward travel toward next stop
+          ELSE
+            CASE 
+              -- Check if there's a next stop to determine direction
+              WHEN EXISTS (SELECT 1 FROM stops WHERE id = s.id + 1) THEN
+                -- Use the vertex that's on the side going toward next stop
+                CASE 
+                  -- If road goes toward next stop (within 90 degrees), use target vertex
+                  WHEN EXISTS (
+                    SELECT 1 FROM stops s2 
+                    WHERE s2.id = s.id + 1
+                    AND ABS(
+                      CASE 
+                        WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) > pi() 
+                        THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) - 2*pi()
+                        WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) < -pi() 
+                        THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) + 2*pi()
+                        ELSE ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom)
+                      END
+                    ) < pi()/2
+                  ) THEN w.target  -- Road goes forward, use target
+                  ELSE w.source  -- Road goes backward or perpendicular, use source
+                END
+              -- Default: closest vertex
+              ELSE
+                CASE 
+                  WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
+                       ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
+                  THEN w.source
+                  ELSE w.target
+                END
+            END
+        END
+      FROM ways w
+      WHERE ST_DWithin(w.the_geom::geography, s.geom::geography, 150)
+        -- Filter oneway roads: for non-first stops, ensure oneways go in correct direction
+        AND (
+          s.id = 1  -- First stop can use any road
+          OR w.oneway IS NULL 
+          OR w.oneway = '' 
+          OR UPPER(TRIM(w.oneway)) = 'NO'
+          OR UPPER(TRIM(w.oneway)) = 'UNKNOWN'
+          -- For oneway='YES', check if it goes toward next stop
+          OR (
+            UPPER(TRIM(w.oneway)) = 'YES' 
+            AND s.id < (SELECT MAX(id) FROM stops)
+            -- Check if road direction aligns with travel direction to next stop
+            AND EXISTS (
+              SELECT 1 FROM stops s2 
+              WHERE s2.id = s.id + 1
+              AND (
+                -- Calculate angle difference (handle circular angles)
+                ABS(
+                  CASE 
+                    WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) > pi() 
+                    THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) - 2*pi()
+                    WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) < -pi() 
+                    THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) + 2*pi()
+                    ELSE ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom)
+                  END
+                ) < pi()/2  -- Road goes within 90 degrees of travel direction
+              )
+            )
+          )
+        )
+      ORDER BY w.the_geom::geography <-> s.geom::geography
+      LIMIT 1
+    )
+    UNION ALL
+    -- Fallback to nearest vertex if no nearby road found
+    (
+      SELECT v.id
+      FROM ways_vertices_pgr v
+      ORDER BY v.the_geom <-> s.geom
+      LIMIT 1
+    )
+    -- Stop at the first row so the fallback only runs when no road matched
+    LIMIT 1
+  ) AS snapped(vertex_id)
+)
+SELECT array_agg(vertex_id ORDER BY id) FROM snap;
+"""
+
+ROUTE_LEGS_QUERY = """
+WITH expanded AS (
+  -- Stops snapped onto a vertex removed by contraction get the original edges
+  -- of its contracted group added back, so they stay reachable
+  SELECT COALESCE(array_agg(DISTINCT g.vertex), '{}') AS vertices
+  FROM contracted_vertex_groups cg
+  CROSS JOIN LATERAL unnest(cg.group_vertices) AS g(vertex)
+  WHERE cg.vertex_id = ANY($1::bigint[] || $2::bigint[])
+),
+route_parts AS (
+  SELECT r.start_vid, r.end_vid, r.path_seq, e.edge_seq, w.the_geom, w.cost_time
+  -- One pgr_astar call for every leg: the contracted graph is built from the
+  -- edges SQL once and each (source, target) pair from the combinations SQL is routed on it
+  FROM pgr_astar(
+    (
+      SELECT format(
+        'SELECT id, source, target, cost, reverse_cost, x1, y1, x2, y2 FROM ways_contracted
+         UNION ALL
+         SELECT id, source, target, cost, reverse_cost, x1, y1, x2, y2 FROM ways_removed
+         WHERE source = ANY(%L) AND target = ANY(%L)',
+        vertices,
+        vertices
+      )
+      FROM expanded
+    ),
+    format(
+      'SELECT unnest(%L::bigint[]) AS source, unnest(%L::bigint[]) AS target',
+      $1::bigint[],
+      $2::bigint[]
+    ),
+    directed := true
+  ) AS r
+  -- Shortcut edges expand back into the original ways they replaced
+  LEFT JOIN ways_shortcuts s ON s.id = r.edge
+  CROSS JOIN LATERAL unnest(COALESCE(s.edge_path, ARRAY[r.edge])) WITH ORDINALITY AS e(gid, edge_seq)
+  JOIN ways w ON w.gid = e.gid  -- Exclude start/end nodes
+)
+SELECT 
+  start_vid,
+  end_vid,
+  -- Edges come back in path order, so collecting them is enough (no GEOS merge)
+  ST_AsBinary(ST_Collect(the_geom ORDER BY path_seq, edge_seq)::geometry(MultiLineString,4326)) AS leg_wkb,
+  SUM(cost_time) AS time_min
+FROM route_parts
+GROUP BY start_vid, end_vid;
+"""
+
+ROUTE_QUERY = """
+WITH stops AS (
+  SELECT id, ST_SetSRID(ST_MakePoint(lng, lat), 4326) AS geom
+  FROM unnest($1::float8[], $2::float8[]) WITH ORDINALITY AS t(lng, lat, id)
+),
+snap AS (
+  SELECT s.id, v.id AS vertex_id
+  FROM stops s
+  CROSS JOIN LATERAL (
+    SELECT id FROM ways_vertices_pgr
+    ORDER BY the_geom <-> s.geom
+    LIMIT 1
+  ) v
+),
+route_parts AS (
+  SELECT r.seq, r.node, r.edge, w.the_geom
+  FROM pgr_astar(
+    'SELECT gid AS id, source, target, cost_time AS cost, reverse_cost_time AS reverse_cost, x1, y1, x2, y2 FROM ways',
+    (SELECT vertex_id FROM snap WHERE id=1),
+    (SELECT vertex_id FROM snap WHERE id=2),
+    directed := true
+  ) AS r
+  LEFT JOIN ways w ON r.edge = w.gid
+),
+full_route AS (
+  SELECT ST_Collect(the_geom ORDER BY seq)::geometry(MultiLineString,4326) AS geom
+  FROM route_parts
+)
+SELECT ST_AsBinary(geom) AS route_wkb FROM full_route;
+"""
+
+def wkb_to_coordinates_json(route_wkb) -> str:
+    """Serialize the lines of a WKB MultiLineString as JSON, without the outer brackets"""
+    geojson = shapely.to_geojson(shapely.from_wkb(bytes(route_wkb)))
+    return geojson[geojson.index("[") + 1:geojson.rindex("]")]
+
+async def stream_route(fields: dict, legs_json: list[bytes]):
+    """Yield a JSON route response, writing route_geojson one leg at a time"""
+    yield orjson.dumps(fields)[:-1] + b',"route_geojson":{"type":"MultiLineString","coordinates":['
+    for i, leg_json in enumerate(legs_json):
+        yield (b"," if i else b"") + leg_json
+    yield b"]}}"
+
+# Routed legs keyed on snapped (source, target) vertex ids, least recently used first
+LEG_CACHE_SIZE = 10_000
+_leg_cache: OrderedDict[tuple[int, int], tuple[bytes, float]] = OrderedDict()
+
+def _get_cached_leg(leg: tuple[int, int]) -> tuple[bytes, float] | None:
+    routed = _leg_cache.get(leg)
+    if routed is not None:
+        _leg_cache.move_to_end(leg)
+    return routed
+
+def _cache_leg(leg: tuple[int, int], routed: tuple[bytes, float]):
+    _leg_cache[leg] = routed
+    _leg_cache.move_to_end(leg)
+    if len(_leg_cache) > LEG_CACHE_SIZE:
+        _leg_cache.popitem(last=False)
 
-def create_multi_stop_route(geocode_results: list[dict]) -> dict:
+async def route_legs(conn, legs: list[tuple[int, int]]) -> dict[tuple[int, int], tuple[bytes, float]]:
+    """Route (source, target) vertex pairs on the contracted graph, running pgr_astar only for legs not already cached"""
+    routed = {}
+    missing = []
+    # Each distinct leg is looked up and routed once, however often the trip repeats it
+    for leg in dict.fromkeys(legs):
+        cached = _get_cached_leg(leg)
+        if cached is not None:
+            routed[leg] = cached
+        else:
+            missing.append(leg)
+    
+    if missing:
+        rows = await conn.fetch(
+            ROUTE_LEGS_QUERY,
+            [source for source, _ in missing],
+            [target for _, target in missing]
+        )
+        for row in rows:
+            leg = (row["start_vid"], row["end_vid"])
+            routed[leg] = (row["leg_wkb"], float(row["time_min"]))
+            _cache_leg(leg, routed[leg])
+    
+    return routed
+
+async def create_multi_stop_route(geocode_results: list[GeocodeResult]) -> dict:
     """Create a multi-stop route using pgRouting from geocoding results"""
     try:
-        # Filter successful geocodes and sort by stop_number
-        successful_stops = [stop for stop in geocode_results if stop.get("status") == "success"]
-        successful_stops.sort(key=lambda x: x.get("stop_number", 0))
+        # Filter successful geocodes and sort by stop_number in a single pass
+        successful_stops = sorted(
+            (stop for stop in geocode_results if stop.status == "success"),
+            key=attrgetter("stop_number")
+        )
         
         if len(successful_stops) < 2:
             return {
@@ -54,232 +361,52 @@ def create_multi_stop_route(geocode_results: list[dict]) -> dict:
                 "successful_stops": len(successful_stops)
             }
         
-        # Build the stops CTE dynamically
-        stops_cte = "WITH stops AS (\n"
-        for i, stop in enumerate(successful_stops, 1):
-            stops_cte += f"  SELECT {i} AS id, ST_SetSRID(ST_Point({stop['lng']},{stop['lat']}),4326) AS geom"
-            if i < len(successful_stops):
-                stops_cte += " UNION ALL\n"
-            else:
-                stops_cte += "\n"
-        stops_cte += "),\n"
+        # Stops are bound as parallel lng/lat arrays so the query text never changes
+        # and asyncpg can reuse the connection's prepared statement
+        async with app.state.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
+            vertex_ids = await conn.fetchval(
+                SNAP_STOPS_QUERY,
+                [stop.lng for stop in successful_stops],
+                [stop.lat for stop in successful_stops]
+            )
+            # Consecutive stops form the legs; don't route to the same vertex
+            legs = [
+                (source, target)
+                for source, target in zip(vertex_ids, vertex_ids[1:])
+                if source is not None and target is not None and source != target
+            ]
+            routed = await route_legs(conn, legs)
         
-        # Build the complete query
-        query = f"""
-        {stops_cte}
-        snap AS (
-          SELECT 
-            s.id,
-            s.geom,
-            COALESCE(
-              -- Try to find closest road segment with direction-aware snapping
-              (
-                SELECT 
-                  CASE 
-                    -- For first stop, use closest vertex
-                    WHEN s.id = 1 THEN
-                      CASE 
-                        WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
-                             ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
-                        THEN w.source
-                        ELSE w.target
-                      END
-                    -- For last stop, use closest vertex
-                    WHEN s.id = (SELECT MAX(id) FROM stops) THEN
-                      CASE 
-                        WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
-                             ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
-                        THEN w.source
-                        ELSE w.target
-                      END
-                    -- For intermediate stops, prefer vertex that allows forward travel toward next stop
-                    ELSE
-                      CASE 
-                        -- Check if there's a next stop to determine direction
-                        WHEN EXISTS (SELECT 1 FROM stops WHERE id = s.id + 1) THEN
-                          -- Use the vertex that's on the side going toward next stop
-                          CASE 
-                            -- If road goes toward next stop (within 90 degrees), use target vertex
-                            WHEN EXISTS (
-                              SELECT 1 FROM stops s2 
-                              WHERE s2.id = s.id + 1
-                              AND ABS(
-                                CASE 
-                                  WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) > pi() 
-                                  THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) - 2*pi()
-                                  WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) < -pi() 
-                                  THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) + 2*pi()
-                                  ELSE ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom)
-                                END
-                              ) < pi()/2
-                            ) THEN w.target  -- Road goes forward, use target
-                            ELSE w.source  -- Road goes backward or perpendicular, use source
-                          END
-                        -- Default: closest vertex
-                        ELSE
-                          CASE 
-                            WHEN ST_Distance(ST_StartPoint(w.the_geom)::geography, s.geom::geography) < 
-                                 ST_Distance(ST_EndPoint(w.the_geom)::geography, s.geom::geography)
-                            THEN w.source
-                            ELSE w.target
-                          END
-                      END
-                  END
-                FROM ways w
-                WHERE ST_DWithin(w.the_geom::geography, s.geom::geography, 150)
-                  -- Filter oneway roads: for non-first stops, ensure oneways go in correct direction
-                  AND (
-                    s.id = 1  -- First stop can use any road
-                    OR w.oneway IS NULL 
-                    OR w.oneway = '' 
-                    OR UPPER(TRIM(w.oneway)) = 'NO'
-                    OR UPPER(TRIM(w.oneway)) = 'UNKNOWN'
-                    -- For oneway='YES', check if it goes toward next stop
-                    OR (
-                      UPPER(TRIM(w.oneway)) = 'YES' 
-                      AND s.id < (SELECT MAX(id) FROM stops)
-                      -- Check if road direction aligns with travel direction to next stop
-                      AND EXISTS (
-                        SELECT 1 FROM stops s2 
-                        WHERE s2.id = s.id + 1
-                        AND (
-                          -- Calculate angle difference (handle circular angles)
-                          ABS(
-                            CASE 
-                              WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) > pi() 
-                              THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) - 2*pi()
-                              WHEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) < -pi() 
-                              THEN ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom) + 2*pi()
-                              ELSE ST_Azimuth(ST_StartPoint(w.the_geom), ST_EndPoint(w.the_geom)) - ST_Azimuth(s.geom, s2.geom)
-                            END
-                          ) < pi()/2  -- Road goes within 90 degrees of travel direction
-                        )
-                      )
-                    )
-                  )
-                ORDER BY ST_Distance(w.the_geom::geography, s.geom::geography)
-                LIMIT 1
-              ),
-              -- Fallback to nearest vertex if no nearby road found
-              (
-                SELECT v.id
-                FROM ways_vertices_pgr v
-                ORDER BY v.the_geom <-> s.geom
-                LIMIT 1
-              )
-            ) AS vertex_id
-          FROM stops s
-        ),
-        pairs AS (
-          SELECT 
-            a.id AS from_id, 
-            a.vertex_id AS source,
-            b.id AS to_id, 
-            b.vertex_id AS target
-          FROM snap a
-          JOIN snap b ON b.id = a.id + 1
-          WHERE a.vertex_id IS NOT NULL 
-            AND b.vertex_id IS NOT NULL
-            AND a.vertex_id != b.vertex_id  -- Don't route to same vertex
-        ),
-        route_parts AS (
-          SELECT 
-            p.from_id, 
-            p.to_id, 
-            r.seq, 
-            r.node, 
-            r.edge, 
-            w.the_geom,
-            w.cost_time,
-            w.name
-          FROM pairs p
-          CROSS JOIN LATERAL pgr_astar(
-            'SELECT gid AS id, 
-                    source, 
-                    target,
-                    CASE 
-                      -- Heavy penalty for wrong-way on reverse oneway (REVERSED means oneway in reverse direction)
-                      WHEN UPPER(TRIM(oneway)) = ''REVERSED'' THEN cost_time * 10000
-                      -- Prefer highways/motorways by reducing their cost (they are faster)
-                      -- Highway 401 has tag_id 101, other highways have 104, 106, etc.
-                      -- Also check for high speed roads (highways typically > 80 km/h)
-                      WHEN tag_id IN (101, 102, 103, 104, 106) OR (priority >= 1.0 AND maxspeed_forward > 80) THEN 
-                        cost_time * 0.6  -- 40% cost reduction for highways (strong preference)
-                      -- Prefer higher speed roads (secondary highways, major roads)
-                      WHEN maxspeed_forward > 80 THEN 
-                        cost_time * 0.75  -- 25% cost reduction for fast roads
-                      WHEN priority >= 1.0 THEN 
-                        cost_time * 0.85  -- 15% cost reduction for priority roads
-                      -- Normal forward cost
-                      ELSE cost_time
-                    END AS cost,
-                    CASE 
-                      -- Impossible to go backwards on one-way (YES means oneway in forward direction)
-                      WHEN UPPER(TRIM(oneway)) = ''YES'' THEN -1
-                      -- Heavy penalty for wrong-way on reverse oneway (going backwards on REVERSED)
-                      WHEN UPPER(TRIM(oneway)) = ''REVERSED'' THEN -1  -- Can''t go backwards on reverse oneway
-                      -- Prefer highways in reverse direction too (but only if not oneway)
-                      WHEN UPPER(TRIM(oneway)) != ''YES'' 
-                        AND (tag_id IN (101, 102, 103, 104, 106) OR (priority >= 1.0 AND maxspeed_forward > 80)) THEN 
-                        reverse_cost_time * 0.6  -- 40% cost reduction for highways
-                      WHEN UPPER(TRIM(oneway)) != ''YES'' AND maxspeed_forward > 80 THEN 
-                        reverse_cost_time * 0.75  -- 25% cost reduction for fast roads
-                      WHEN UPPER(TRIM(oneway)) != ''YES'' AND priority >= 1.0 THEN 
-                        reverse_cost_time * 0.85  -- 15% cost reduction for priority roads
-                      -- Normal reverse cost
-                      ELSE reverse_cost_time
-                    END AS reverse_cost,
-                    x1, y1, x2, y2
-             FROM ways
-             WHERE true',
-            p.source, 
-            p.target,
-            directed := true
-          ) AS r
-          LEFT JOIN ways w ON r.edge = w.gid
-          WHERE r.edge > 0  -- Exclude start/end nodes
-        ),
-        full_route AS (
-          SELECT 
-            ST_LineMerge(ST_Collect(the_geom ORDER BY from_id, seq))::geometry(MultiLineString,4326) AS geom,
-            SUM(cost_time) AS total_time_min,
-            COUNT(DISTINCT from_id) AS segment_count
-          FROM route_parts
-        )
-        SELECT 
-          ST_AsGeoJSON(geom) AS route_geojson,
-          total_time_min,
-          segment_count
-        FROM full_route;
-        """
-        
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query)
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
+        # Put the routed legs back in stop order; geometry is serialized when streamed
+        route_wkbs = []
+        total_time_min = 0.0
+        for leg in legs:
+            if leg not in routed:
+                continue
+            leg_wkb, time_min = routed[leg]
+            route_wkbs.append(leg_wkb)
+            total_time_min += time_min
         
-        if result and result[0]:
+        if route_wkbs:
             # Prepare stop details for response
             stop_details = []
             for stop in successful_stops:
                 stop_info = {
-                    "stop_number": stop.get("stop_number", 0),
-                    "address": stop.get("address", ""),
-                    "lat": stop.get("lat"),
-                    "lng": stop.get("lng"),
-                    "formatted_address": stop.get("formatted_address", "")
+                    "stop_number": stop.stop_number,
+                    "address": stop.address,
+                    "lat": stop.lat,
+                    "lng": stop.lng,
+                    "formatted_address": stop.formatted_address
                 }
                 stop_details.append(stop_info)
             
             return {
                 "success": True,
-                "route_geojson": json.loads(result[0]),
+                "route_wkbs": route_wkbs,
                 "total_stops": len(successful_stops),
                 "stops": stop_details,
-                "total_time_min": float(result[1]) if result[1] is not None else None,
-                "segment_count": int(result[2]) if result[2] is not None else None
+                "total_time_min": total_time_min,
+                "segment_count": len(route_wkbs)
             }
         else:
             return {
@@ -295,80 +422,39 @@ def create_multi_stop_route(geocode_results: list[dict]) -> dict:
 
 
 @app.post("/route")
-def get_route(request: CoordinateRequest):
+async def get_route(request: CoordinateRequest):
     """
-    Calculate route between two points using coordinate strings.
+    Calculate route between two points using [lat, lng] coordinate pairs.
     
     Request body:
     {
-        "start_coords": "43.43656,-80.45172",
-        "end_coords": "43.43656,-80.45172"
+        "start_coords": [43.43656, -80.45172],
+        "end_coords": [43.45067, -80.49208]
     }
     """
     try:
-        # Parse start coordinates
-        start_lat, start_lng = request.start_coords.split(',')
-        start_lat = float(start_lat.strip())
-        start_lng = float(start_lng.strip())
+        start_lat, start_lng = request.start_coords
+        end_lat, end_lng = request.end_coords
         
-        # Parse end coordinates
-        end_lat, end_lng = request.end_coords.split(',')
-        end_lat = float(end_lat.strip())
-        end_lng = float(end_lng.strip())
-        
-        query = f"""
-        WITH stops AS (
-          SELECT 1 AS id, ST_SetSRID(ST_Point({start_lng},{start_lat}),4326) AS geom UNION ALL
-          SELECT 2, ST_SetSRID(ST_Point({end_lng},{end_lat}),4326)
-        ),
-        snap AS (
-          SELECT id, (
-            SELECT id FROM ways_vertices_pgr
-            ORDER BY the_geom <-> stops.geom
-            LIMIT 1
-          ) AS vertex_id
-          FROM stops
-        ),
-        route_parts AS (
-          SELECT r.seq, r.node, r.edge, w.the_geom
-          FROM pgr_astar(
-            'SELECT gid AS id, source, target, cost_time AS cost, reverse_cost_time AS reverse_cost, x1, y1, x2, y2 FROM ways',
-            (SELECT vertex_id FROM snap WHERE id=1),
-            (SELECT vertex_id FROM snap WHERE id=2),
-            directed := true
-          ) AS r
-          LEFT JOIN ways w ON r.edge = w.gid
-        ),
-        full_route AS (
-          SELECT ST_LineMerge(ST_Collect(the_geom))::geometry(MultiLineString,4326) AS geom
-          FROM route_parts
-        )
-        SELECT ST_AsGeoJSON(geom) AS route_geojson FROM full_route;
-        """
-        
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query)
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
+        async with app.state.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
+            result = await conn.fetchrow(ROUTE_QUERY, [start_lng, end_lng], [start_lat, end_lat])
         
         if result and result[0]:
-            return {
+            fields = {
                 "success": True,
-                "route_geojson": json.loads(result[0]),
                 "start_coords": request.start_coords,
                 "end_coords": request.end_coords
             }
+            # Decoded before the response starts, so a bad geometry is still an error response
+            legs_json = [wkb_to_coordinates_json(result[0]).encode()]
+            return StreamingResponse(stream_route(fields, legs_json), media_type="application/json")
         else:
             return {"error": "No route found"}
-    except ValueError as e:
-        return {"error": f"Invalid coordinate format. Expected 'lat,lng' format. Error: {str(e)}"}
     except Exception as e:
         return {"error": str(e)}
 
 @app.post("/route-from-batch", response_model=RouteFromBatchResponse)
-def route_from_batch_geocoding(request: RouteFromBatchRequest):
+async def route_from_batch_geocoding(request: RouteFromBatchRequest):
     """
     Create a multi-stop route from batch geocoding results.
     Takes the results from /geocode-batch and creates a route.
@@ -423,16 +509,18 @@ def route_from_batch_geocoding(request: RouteFromBatchRequest):
         if len(request.geocode_results) > 100:
             raise HTTPException(status_code=400, detail="Maximum 100 stops allowed")
         
-        # Convert Pydantic models to dicts for processing
-        geocode_dicts = [item for item in request.geocode_results]
-        
         # Create the multi-stop route
-        route_result = create_multi_stop_route(geocode_dicts)
+        route_result = await create_multi_stop_route(request.geocode_results)
         
         if not route_result["success"]:
             raise HTTPException(status_code=400, detail=route_result["error"])
         
-        return RouteFromBatchResponse(**route_result)
+        # Stream the route instead of building (and re-validating) the whole
+        # RouteFromBatchResponse in memory; the model still documents the shape
+        # Legs are decoded here, before the 200 is sent, so a bad geometry
+        # becomes a 500 rather than a truncated body
+        legs_json = [wkb_to_coordinates_json(w).encode() for w in route_result.pop("route_wkbs")]
+        return StreamingResponse(stream_route(route_result, legs_json), media_type="application/json")
         
     except HTTPException:
         raise
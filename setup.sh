@@ -24,6 +24,7 @@ NC='\033[0m' # No Color
 DB_NAME="kitchener_routing"
 DB_USER="postgres"
 DB_PASSWORD="takeme@kw"
+PGBOUNCER_PORT="6432"
 OSM_FILE="ontario-latest.osm.pbf"
 REGION_FILE="kitchener.osm.pbf"
 REGION_OSM="kitchener.osm"
@@ -89,6 +90,7 @@ main() {
         wget \
         unzip \
         osmctools \
+        pgbouncer \
         postgresql-17-pgrouting
     
     print_success "All packages installed successfully"
@@ -157,6 +159,7 @@ main() {
         CREATE INDEX IF NOT EXISTS idx_ways_target ON ways(target);
         CREATE INDEX IF NOT EXISTS idx_ways_vertices_pgr_geom ON ways_vertices_pgr USING GIST(the_geom);
         CREATE INDEX IF NOT EXISTS idx_ways_geom ON ways USING GIST(the_geom);
+        CREATE INDEX IF NOT EXISTS idx_ways_geog ON ways USING GIST((the_geom::geography));
         ANALYZE ways;
         ANALYZE ways_vertices_pgr;
     "
@@ -180,6 +183,181 @@ main() {
     "
     print_success "Time-based cost columns added and calculated"
     
+    # Step 8.6: Precompute the routing costs used by the multi-stop A* search
+    # Stored generated columns are recalculated whenever cost_time or
+    # reverse_cost_time change, so routing reads plain values per edge.
+    print_status "Adding adjusted routing cost columns to ways table..."
+    sudo -u postgres psql -d "$DB_NAME" -c "
+        ALTER TABLE ways ADD COLUMN IF NOT EXISTS cost_adj DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE
+                -- Heavy penalty for wrong-way on reverse oneway (REVERSED means oneway in reverse direction)
+                WHEN UPPER(TRIM(oneway)) = 'REVERSED' THEN cost_time * 10000
+                -- Prefer highways/motorways (Highway 401 has tag_id 101, other highways 104, 106, etc.)
+                WHEN tag_id IN (101, 102, 103, 104, 106) OR (priority >= 1.0 AND maxspeed_forward > 80) THEN
+                    cost_time * 0.6  -- 40% cost reduction for highways (strong preference)
+                -- Prefer higher speed roads (secondary highways, major roads)
+                WHEN maxspeed_forward > 80 THEN
+                    cost_time * 0.75  -- 25% cost reduction for fast roads
+                WHEN priority >= 1.0 THEN
+                    cost_time * 0.85  -- 15% cost reduction for priority roads
+                ELSE cost_time
+            END
+        ) STORED;
+        
+        ALTER TABLE ways ADD COLUMN IF NOT EXISTS rev_cost_adj DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE
+                -- Impossible to go backwards on one-way (YES means oneway in forward direction)
+                WHEN UPPER(TRIM(oneway)) = 'YES' THEN -1
+                -- Can't go backwards on reverse oneway
+                WHEN UPPER(TRIM(oneway)) = 'REVERSED' THEN -1
+                -- Prefer highways in reverse direction too (but only if not oneway)
+                WHEN UPPER(TRIM(oneway)) != 'YES'
+                    AND (tag_id IN (101, 102, 103, 104, 106) OR (priority >= 1.0 AND maxspeed_forward > 80)) THEN
+                    reverse_cost_time * 0.6  -- 40% cost reduction for highways
+                WHEN UPPER(TRIM(oneway)) != 'YES' AND maxspeed_forward > 80 THEN
+                    reverse_cost_time * 0.75  -- 25% cost reduction for fast roads
+                WHEN UPPER(TRIM(oneway)) != 'YES' AND priority >= 1.0 THEN
+                    reverse_cost_time * 0.85  -- 15% cost reduction for priority roads
+                ELSE reverse_cost_time
+            END
+        ) STORED;
+        
+        ANALYZE ways;
+    "
+    print_success "Adjusted routing cost columns added"
+    
+    # Step 8.7: Wrap the routing edges in a SQL function
+    # The contraction step below builds every multi-stop graph table from this
+    # one definition of the adjusted edges; nothing calls it at request time.
+    print_status "Creating ways_for_routing() function..."
+    sudo -u postgres psql -d "$DB_NAME" -c "
+        DROP TYPE IF EXISTS ways_routing_row CASCADE;
+        CREATE TYPE ways_routing_row AS (
+            id BIGINT,
+            source BIGINT,
+            target BIGINT,
+            cost DOUBLE PRECISION,
+            reverse_cost DOUBLE PRECISION,
+            x1 DOUBLE PRECISION,
+            y1 DOUBLE PRECISION,
+            x2 DOUBLE PRECISION,
+            y2 DOUBLE PRECISION
+        );
+        
+        CREATE OR REPLACE FUNCTION ways_for_routing() RETURNS SETOF ways_routing_row AS '
+            SELECT gid, source, target, cost_adj, rev_cost_adj, x1, y1, x2, y2 FROM ways
+        ' LANGUAGE sql STABLE;
+    "
+    print_success "ways_for_routing() function created"
+    
+    # Step 8.8: Covering index for the /route A* edges scan
+    # /route still routes on ways with the plain time costs; every column its
+    # edges SQL reads lives in this index, so once the table is vacuumed that
+    # scan can be answered by an index-only scan. Multi-stop routes read the
+    # contracted tables built in Step 8.9 instead.
+    print_status "Creating covering index for routing..."
+    sudo -u postgres psql -d "$DB_NAME" -c "
+        -- Indexes from older setups that no request-time query uses
+        DROP INDEX IF EXISTS ways_astar_cover;
+        DROP INDEX IF EXISTS ways_gid_brin;
+        CREATE INDEX IF NOT EXISTS ways_route_cover ON ways USING btree(source)
+            INCLUDE (gid, target, cost_time, reverse_cost_time, x1, y1, x2, y2);
+    "
+    # VACUUM can't run inside the implicit transaction of a multi-statement -c
+    sudo -u postgres psql -d "$DB_NAME" -c "VACUUM ANALYZE ways;"
+    print_success "Covering index created"
+    
+    # Step 8.9: Build a contracted routing graph for multi-stop routes
+    # Dead-end and linear contraction remove vertices the A* search would
+    # otherwise expand one by one. Shortcut edges keep the original edges they
+    # replace (edge_path) so routes can be drawn on the real road geometry.
+    print_status "Building contracted routing graph (this may take several minutes)..."
+    sudo -u postgres psql -d "$DB_NAME" -c "
+        -- ways_contraction is only kept by older setups; it is a temp table now
+        DROP TABLE IF EXISTS ways_contraction, contracted_vertex_groups, ways_removed, ways_shortcuts, ways_contracted;
+        
+        -- Raw pgr_contraction output, only needed while the tables below are built
+        CREATE TEMP TABLE ways_contraction AS
+        SELECT * FROM pgr_contraction(
+            'SELECT id, source, target, cost, reverse_cost FROM ways_for_routing()',
+            ARRAY[1, 2],
+            directed := true
+        );
+        
+        -- Every removed vertex, with all vertices of the contraction group(s) it belongs to
+        CREATE TABLE contracted_vertex_groups AS
+        SELECT c.vertex_id, array_agg(DISTINCT m.member) AS group_vertices
+        FROM ways_contraction wc
+        CROSS JOIN LATERAL unnest(wc.contracted_vertices) AS c(vertex_id)
+        CROSS JOIN LATERAL unnest(
+            CASE WHEN wc.type = 'v' THEN wc.id || wc.contracted_vertices
+                 ELSE ARRAY[wc.source, wc.target] || wc.contracted_vertices
+            END
+        ) AS m(member)
+        GROUP BY c.vertex_id;
+        CREATE INDEX ON contracted_vertex_groups(vertex_id);
+        
+        -- Original edges touching a removed vertex
+        CREATE TABLE ways_removed AS
+        SELECT r.* FROM ways_for_routing() r
+        WHERE r.source IN (SELECT vertex_id FROM contracted_vertex_groups)
+           OR r.target IN (SELECT vertex_id FROM contracted_vertex_groups);
+        CREATE INDEX ON ways_removed(source);
+        CREATE INDEX ON ways_removed(target);
+        
+        -- pgr_contraction numbers shortcuts -1, -2, ...; move them past every gid
+        CREATE TABLE ways_shortcuts AS
+        SELECT
+            (SELECT MAX(gid) FROM ways) - wc.id AS id,
+            wc.source,
+            wc.target,
+            wc.cost,
+            -1::DOUBLE PRECISION AS reverse_cost,
+            ST_X(vs.the_geom) AS x1, ST_Y(vs.the_geom) AS y1,
+            ST_X(vt.the_geom) AS x2, ST_Y(vt.the_geom) AS y2,
+            ARRAY(
+                SELECT d.edge
+                FROM pgr_dijkstra(
+                    format(
+                        'SELECT id, source, target, cost, reverse_cost FROM ways_removed
+                         WHERE source = ANY(%L) AND target = ANY(%L)',
+                        g.members, g.members
+                    ),
+                    wc.source, wc.target,
+                    directed := true
+                ) AS d
+                WHERE d.edge > 0
+                ORDER BY d.path_seq
+            ) AS edge_path
+        FROM ways_contraction wc
+        JOIN ways_vertices_pgr vs ON vs.id = wc.source
+        JOIN ways_vertices_pgr vt ON vt.id = wc.target
+        CROSS JOIN LATERAL (SELECT ARRAY[wc.source, wc.target] || wc.contracted_vertices AS members) g
+        WHERE wc.type = 'e';
+        CREATE INDEX ON ways_shortcuts(id);
+        
+        -- The graph multi-stop routes run on: untouched edges plus shortcuts
+        CREATE TABLE ways_contracted AS
+        SELECT r.* FROM ways_for_routing() r
+        WHERE r.source NOT IN (SELECT vertex_id FROM contracted_vertex_groups)
+          AND r.target NOT IN (SELECT vertex_id FROM contracted_vertex_groups)
+        UNION ALL
+        SELECT id, source, target, cost, reverse_cost, x1, y1, x2, y2 FROM ways_shortcuts;
+        
+        ANALYZE contracted_vertex_groups;
+        ANALYZE ways_removed;
+        ANALYZE ways_shortcuts;
+        ANALYZE ways_contracted;
+    "
+    # A shortcut with no original edges would leave a gap in the drawn route
+    # and drop its time from time_min
+    EMPTY_PATHS=$(sudo -u postgres psql -d "$DB_NAME" -tAc "SELECT count(*) FROM ways_shortcuts WHERE cardinality(edge_path) = 0")
+    if [ "$EMPTY_PATHS" != "0" ]; then
+        print_error "$EMPTY_PATHS shortcut edge(s) could not be expanded into original ways"
+        exit 1
+    fi
+    print_success "Contracted routing graph built"
+    
     # Step 9: Test the setup
     print_status "Testing the setup..."
     sudo -u postgres psql -d "$DB_NAME" -c "
@@ -194,18 +372,45 @@ main() {
         UNION ALL
         SELECT 'Vertices count: ' || count(*)::text FROM ways_vertices_pgr;
     "
-    
+
+    # Step 9.5: Put PgBouncer in front of PostgreSQL
+    # Transaction pooling shares a small set of server connections across all
+    # API workers. Each route runs as a single transaction; asyncpg's prepared
+    # statements are tracked across server connections by max_prepared_statements
+    # (PgBouncer 1.21+).
+    print_status "Configuring PgBouncer (transaction pooling on port $PGBOUNCER_PORT)..."
+    sudo tee /etc/pgbouncer/pgbouncer.ini >/dev/null <<EOF
+[databases]
+$DB_NAME = host=localhost port=5432 dbname=$DB_NAME
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = $PGBOUNCER_PORT
+auth_type = scram-sha-256
+auth_file = /etc/pgbouncer/userlist.txt
+pool_mode = transaction
+max_client_conn = 10000
+default_pool_size = 20
+max_prepared_statements = 100
+EOF
+    echo "\"$DB_USER\" \"$DB_PASSWORD\"" | sudo tee /etc/pgbouncer/userlist.txt >/dev/null
+    sudo chown postgres:postgres /etc/pgbouncer/userlist.txt
+    sudo chmod 600 /etc/pgbouncer/userlist.txt
+    sudo systemctl restart pgbouncer
+    sudo systemctl enable pgbouncer
+    print_success "PgBouncer configured"
+
     print_success "Setup completed successfully!"
     print_status "Database connection details:"
     echo "  Host: localhost"
-    echo "  Port: 5432"
+    echo "  Port: 5432 (PgBouncer: $PGBOUNCER_PORT)"
     echo "  Database: $DB_NAME"
     echo "  User: $DB_USER"
     echo "  Password: $DB_PASSWORD"
     
  # Step 10: Install Python packages
     print_status "Installing Python packages..."
-    sudo apt install python3-fastapi python3-uvicorn python3-psycopg2 python3-dotenv -y
+    sudo apt install python3-fastapi python3-uvicorn python3-asyncpg python3-dotenv python3-shapely python3-orjson -y
     print_success "Python packages installed"
     
     # Step 11: Start the FastAPI server